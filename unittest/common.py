@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+# Helpers shared between the unittest scripts in this directory.
+
+import os
+import select
+import struct
+import time
+
+# The tests run against the release build because it is what users run and it starts faster. Set
+# the EVSIEVE_BIN environment variable to test another build, e.g. target/debug/evsieve.
+EVSIEVE_PROGRAM = [os.environ.get("EVSIEVE_BIN", "target/release/evsieve")]
+
+if not os.path.exists(EVSIEVE_PROGRAM[0]):
+    raise Exception(f"Cannot carry out the unittests: {EVSIEVE_PROGRAM[0]} does not exist. Run `cargo build --release` first.")
+
+# The layout of the kernel's struct input_event: a struct timeval followed by type, code and value.
+INPUT_EVENT = struct.Struct("@llHHi")
+
+def pack_events(events) -> bytes:
+    # Packs the events into the raw struct input_event layout accepted by uinput. The kernel ignores
+    # the timestamp of events written to uinput, so it is left zero.
+    return b"".join(INPUT_EVENT.pack(0, 0, type, code, value) for (type, code, value) in events)
+
+def write_events(device, events):
+    # Writes all events to the uinput device using a single writev() syscall, one struct per
+    # iovec, so they need not be joined into one buffer first.
+    os.writev(device.fd, [INPUT_EVENT.pack(0, 0, type, code, value) for (type, code, value) in events])
+
+def wait_for_path(path, timeout=2.0):
+    # Polls until the path exists, instead of sleeping for a fixed amount of time that has to
+    # account for the slowest possible system. The interval starts at a millisecond and backs off
+    # to 50 ms, so a slow system is not kept busy polling.
+    deadline = time.monotonic() + timeout
+    interval = 0.001
+    while not os.path.exists(path):
+        if time.monotonic() >= deadline:
+            raise Exception(f"Timed out while waiting for {path} to appear.")
+        time.sleep(interval)
+        interval = min(interval * 2, 0.05)
+
+def wait_for_events(device, count, timeout=1.0):
+    # Reads events from the device as soon as they become available, until either `count` events
+    # have been received or the timeout expires. Returns all received events as tuples.
+    events = []
+    deadline = time.monotonic() + timeout
+    while len(events) < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        readable, _, _ = select.select([device.fd], [], [], remaining)
+        if not readable:
+            break
+        # Read everything the kernel has buffered at once rather than going through evdev's
+        # per-event InputEvent objects.
+        data = os.read(device.fd, INPUT_EVENT.size * max(64, count))
+        events += [
+            (type, code, value)
+            for (_sec, _usec, type, code, value) in INPUT_EVENT.iter_unpack(data)
+        ]
+    return events
+
+def atomic_symlink(target, link):
+    # Creates the symlink at a temporary path and renames it over the link, which atomically
+    # replaces whatever was at that path before without needing to check for its existence.
+    tmp_link = f"{link}.tmp{os.getpid()}"
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+
+def remove_stale_link(path):
+    # Evsieve removes the links it creates when it exits gracefully, but not when it gets killed.
+    if os.path.islink(path):
+        os.unlink(path)
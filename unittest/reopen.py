@@ -8,7 +8,7 @@ import os
 import subprocess as sp
 import time
 
-EVSIEVE_PROGRAM = ["target/debug/evsieve"]
+from common import EVSIEVE_PROGRAM, write_events, wait_for_path, wait_for_events, atomic_symlink, remove_stale_link
 
 output_path = "/dev/input/by-id/evsieve-unittest-reopen-out"
 symlink_chain = [
@@ -18,76 +18,69 @@ symlink_chain = [
 ]
 
 capabilities = {e.EV_KEY: [e.KEY_A]}
-input_device = evdev.UInput(capabilities)
-
-def create_links():
-    global input_device
 
+def create_links(input_device):
     current_path = input_device.device
     for link in symlink_chain:
-        if os.path.exists(link) or os.path.islink(link):
-            os.unlink(link)
         os.makedirs(os.path.dirname(link), exist_ok=True)
-        os.symlink(current_path, link)
+        atomic_symlink(current_path, link)
         current_path = link
 
-create_links()
+def test_send_events(input_device, output_device):
+    expected_events = [(e.EV_KEY, e.KEY_A, 1), (e.EV_SYN, 0, 0), (e.EV_KEY, e.KEY_A, 0), (e.EV_SYN, 0, 0)]
 
-subprocess = sp.Popen(EVSIEVE_PROGRAM + [
-    "--input", symlink_chain[-1], "grab=force", "persist=reopen",
-    "--output", f"create-link={output_path}"
-])
+    write_events(input_device, expected_events)
 
-time.sleep(0.5)
+    received_events = wait_for_events(output_device, len(expected_events))
+    assert(received_events[:len(expected_events)] == expected_events)
 
-output_device = evdev.InputDevice(output_path)
-output_device.grab()
+def main():
+    input_device = evdev.UInput(capabilities)
+    create_links(input_device)
 
-def test_send_events():
-    global input_device
-    global output_device
+    remove_stale_link(output_path)
 
-    expected_events = [(e.EV_KEY, e.KEY_A, 1), (e.EV_SYN, 0, 0), (e.EV_KEY, e.KEY_A, 0), (e.EV_SYN, 0, 0)]
+    subprocess = sp.Popen(EVSIEVE_PROGRAM + [
+        "--input", symlink_chain[-1], "grab=force", "persist=reopen",
+        "--output", f"create-link={output_path}"
+    ])
 
-    for event in expected_events:
-        input_device.write(event[0], event[1], event[2])
-    time.sleep(0.01)
+    wait_for_path(output_path)
 
-    received_events = 0
-    for expected_event, real_event in zip(expected_events, output_device.read()):
-        event = (real_event.type, real_event.code, real_event.value)
-        assert(expected_event == event)
-        received_events += 1
-    assert(received_events == len(expected_events))
+    output_device = evdev.InputDevice(output_path)
+    output_device.grab()
 
-test_send_events()
+    test_send_events(input_device, output_device)
+
+    # Destroy the device and then recreate it.
+    input_device.close()
+    for link in symlink_chain:
+        os.unlink(link)
+    time.sleep(0.1)
 
-# Destroy the device and then recreate it.
-input_device.close()
-for link in symlink_chain:
-    os.unlink(link)
-time.sleep(0.1)
+    input_device = evdev.UInput(capabilities)
+    create_links(input_device)
+    time.sleep(0.1)
 
-input_device = evdev.UInput(capabilities)
-create_links()
-time.sleep(0.1)
+    # Test whether evsieve has picked up the new device.
+    test_send_events(input_device, output_device)
 
-# Test whether evsieve has picked up the new device.
-test_send_events()
+    # This time only destroy the last link in the chain.
+    input_device.close()
+    os.unlink(symlink_chain[0])
+    time.sleep(0.1)
 
-# This time only destroy the last link in the chain.
-input_device.close()
-os.unlink(symlink_chain[0])
-time.sleep(0.1)
+    input_device = evdev.UInput(capabilities)
+    os.symlink(input_device.device, symlink_chain[0])
+    time.sleep(0.1)
 
-input_device = evdev.UInput(capabilities)
-os.symlink(input_device.device, symlink_chain[0])
-time.sleep(0.1)
+    test_send_events(input_device, output_device)
 
-test_send_events()
+    print("Unittest successful.")
 
-print("Unittest successful.")
+    subprocess.kill()
+    input_device.close()
+    output_device.close()
 
-subprocess.kill()
-input_device.close()
-output_device.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+# Runs all unittest scripts in a single interpreter, so python-evdev only has to be imported once.
+
+import sys
+
+import reopen
+# Since this script's directory comes first on sys.path, this imports unittest/unittest.py rather
+# than the standard library module of the same name.
+import unittest as evsieve_unittest
+
+def main():
+    # Run reopen.py even if a test in unittest.py failed, so one failure cannot hide another.
+    failed = evsieve_unittest.main()
+    reopen.main()
+    if failed:
+        sys.exit(1)
+
+# unittest.main() starts a process pool, whose workers re-import this script under the spawn and
+# forkserver start methods.
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,155 @@
 import evdev
 import evdev.ecodes as e
 from typing import *
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import functools
 import os
+import select
 import subprocess as sp
+import sys
+import threading
 import time
+import traceback
+
+from common import EVSIEVE_PROGRAM, INPUT_EVENT, pack_events, write_events, wait_for_path, remove_stale_link
+
+EV_SYN = e.EV_SYN
+SYN_REPORT_EVENT = (e.EV_SYN, e.SYN_REPORT, 0)
+
+@functools.lru_cache(maxsize=None)
+def format_event(event) -> str:
+    # Returns a readable representation of an event for failure messages, e.g. (EV_KEY, KEY_A, 1).
+    if event is None:
+        return "None"
+    type, code, value = event
+    type_name = e.EV.get(type, type)
+    code_name = e.bytype.get(type, dict()).get(code, code)
+    if isinstance(code_name, list):
+        code_name = code_name[0]
+    return f"({type_name}, {code_name}, {value})"
+
+def read_output_events(output_devices, auto_syn, timeout=1.0, quiet_period=0.03):
+    # Returns for each output device the events it emitted. Instead of sleeping for a fixed amount
+    # of time, waits on all devices at once until each of them has emitted at least as many events
+    # as it is expected to, or until the timeout expires. After that, keeps reading until no new
+    # events have arrived for quiet_period seconds, so unexpected trailing events are caught too.
+    # The quiet period has to outlast evsieve being descheduled for a moment while the other tests
+    # in the pool keep the CPUs busy; trailing events arriving later than that are not detected.
+    received_events = [[] for _ in output_devices]
+    fd_to_index = {device.fd: index for index, (device, _) in enumerate(output_devices)}
+    max_events = max(1, len(output_devices))
+    with select.epoll() as epoll:
+        for fd in fd_to_index.keys():
+            epoll.register(fd, select.EPOLLIN | select.EPOLLET)
+
+        def drain(ready):
+            for fd, _ in ready:
+                # Edge-triggered notifications only fire again once new events arrive, so every
+                # ready device must be read until it is empty.
+                while True:
+                    try:
+                        data = os.read(fd, INPUT_EVENT.size * 256)
+                    except BlockingIOError:
+                        break
+                    received_events[fd_to_index[fd]] += [
+                        (type, code, value)
+                        for (_sec, _usec, type, code, value) in INPUT_EVENT.iter_unpack(data)
+                        if not (auto_syn and type == EV_SYN)
+                    ]
+
+        deadline = time.monotonic() + timeout
+        while any(
+            len(received) < len(events)
+            for received, (_, events) in zip(received_events, output_devices)
+        ):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return received_events
+            drain(epoll.poll(remaining, max_events))
+
+        while time.monotonic() < deadline:
+            ready = epoll.poll(quiet_period, max_events)
+            if not ready:
+                break
+            drain(ready)
+    return received_events
+
+class OutputCollector:
+    # Reads everything written to a file on a background thread, so the writing process never
+    # blocks on a full pipe and the test can stop waiting as soon as the output is complete.
+    def __init__(self, file):
+        self.data = bytearray()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, args=(file,), daemon=True)
+        self.thread.start()
+
+    def _run(self, file):
+        while True:
+            chunk = file.read1()
+            if not chunk:
+                break
+            with self.condition:
+                self.data += chunk
+                self.condition.notify_all()
+
+    def wait_for_output(self, expected_size, timeout=1.0, grace_period=0.05):
+        # Waits until at least expected_size bytes have been received, and then a while longer to
+        # catch any output beyond what was expected.
+        with self.condition:
+            if self.condition.wait_for(lambda: len(self.data) >= expected_size, timeout):
+                self.condition.wait_for(lambda: len(self.data) > expected_size, grace_period)
+
+    def finish(self) -> str:
+        # Must only be called after the writing end is closed.
+        self.thread.join(timeout=1.0)
+        with self.condition:
+            return self.data.decode("utf8")
+
+class UInputPool:
+    # Creating a virtual input device takes a dozen ioctls and a round trip through udev, so devices
+    # are kept after a test ends and reused by later tests that need the same capabilities.
+    # Only devices with nothing but EV_KEY and EV_REL events are pooled: the kernel remembers the
+    # current value of EV_ABS, EV_LED and EV_SW codes and drops events that do not change it, so a
+    # reused device with such codes could silently swallow the first event of the next test.
+    POOLABLE_TYPES = {e.EV_SYN, e.EV_KEY, e.EV_REL}
+
+    def __init__(self):
+        self.free_devices = defaultdict(list)
+        self.device_keys = dict()
+
+    def acquire(self, capabilities):
+        capabilities = {type: sorted(set(codes)) for type, codes in capabilities.items()}
+        if not capabilities.keys() <= self.POOLABLE_TYPES:
+            return evdev.UInput(capabilities)
+        key = frozenset((type, tuple(codes)) for type, codes in capabilities.items())
+        if self.free_devices[key]:
+            device = self.free_devices[key].pop()
+            # Make sure no key is held down from a previous test that was aborted halfway.
+            release_all = [(e.EV_KEY, code, 0) for code in capabilities.get(e.EV_KEY, [])]
+            write_events(device, release_all + [SYN_REPORT_EVENT])
+        else:
+            device = evdev.UInput(capabilities)
+            self.device_keys[device] = key
+        return device
+
+    def release(self, device):
+        if device in self.device_keys:
+            self.free_devices[self.device_keys[device]].append(device)
+        else:
+            device.close()
+
+uinput_pool = UInputPool()
 
-EVSIEVE_PROGRAM = ["target/debug/evsieve"]
+def stop_process(process):
+    process.terminate()
+    # Make sure evsieve has released its inputs before they return to the pool.
+    try:
+        process.wait(timeout=1.0)
+    except sp.TimeoutExpired:
+        process.kill()
+        process.wait()
 
 def run_unittest(
     arguments: List[str],
@@ -16,74 +160,94 @@ def run_unittest(
     output: Dict[str, List[Tuple[int, int, int]]],
     auto_syn = True,
     expected_output = None,
+    pace = 0.0,
 ):
-    # Create virtual input devices.
-    input_devices = dict()
-    for path, events in input.items():
-        type_capabilities = set([type for (type, _, _) in events])
-        capabilities = {
-            type: [
-                code
-                for (_type, code, _) in events
-                if _type == type
-            ]
-            for type in type_capabilities
-        }
-        input_device = evdev.UInput(capabilities)
-        if os.path.exists(path) or os.path.islink(path):
-            raise Exception(f"Cannot carry out the unittest: required path {path} is already occupied.")
-        os.symlink(input_device.device, path)
-        input_devices[input_device] = events
-
-    # Run the actual program.
-    process = sp.Popen(EVSIEVE_PROGRAM + arguments, stdout=sp.PIPE)
-    # Give the process some time to create the output devices.
-    time.sleep(0.2)
+    # Every resource is registered for cleanup as soon as it has been created, so nothing leaks
+    # if the test fails halfway through setting itself up. They are cleaned up in reverse order.
+    with contextlib.ExitStack() as cleanup:
+        # Create virtual input devices.
+        input_devices = []
+        for path, events in input.items():
+            capabilities = defaultdict(set)
+            for (type, code, _) in events:
+                capabilities[type].add(code)
+            input_device = uinput_pool.acquire(capabilities)
+            cleanup.callback(uinput_pool.release, input_device)
+            if os.path.lexists(path):
+                raise Exception(f"Cannot carry out the unittest: required path {path} is already occupied.")
+            os.symlink(input_device.device, path)
+            cleanup.callback(os.unlink, path)
+            # Pack every report ahead of time, so sending it only costs a single write.
+            if auto_syn:
+                reports = [pack_events([event, SYN_REPORT_EVENT]) for event in events]
+            else:
+                reports = [pack_events([event]) for event in events]
+            input_devices.append((input_device, reports))
+
+        # Remove output links that a previously killed evsieve may have left behind, so waiting for
+        # the output paths cannot succeed before this evsieve process has created them.
+        for path in output.keys():
+            remove_stale_link(path)
+            if os.path.lexists(path):
+                raise Exception(f"Cannot carry out the unittest: required path {path} is already occupied.")
+            cleanup.callback(remove_stale_link, path)
+
+        # Run the actual program.
+        # Only capture stdout for tests that check it.
+        if expected_output is not None:
+            process = sp.Popen(EVSIEVE_PROGRAM + arguments, stdout=sp.PIPE)
+            cleanup.callback(stop_process, process)
+            stdout = OutputCollector(process.stdout)
+            cleanup.callback(stdout.wait_for_output, len(expected_output.encode("utf8")))
+        else:
+            process = sp.Popen(EVSIEVE_PROGRAM + arguments, stdout=sp.DEVNULL)
+            cleanup.callback(stop_process, process)
+
+        # Evsieve opens its input devices before it creates its output devices, so once all output
+        # devices exist, it is ready to receive events. Without output devices there is nothing to
+        # observe, so give the process some time to open the input devices instead.
+        if len(output) > 0:
+            for path in output.keys():
+                wait_for_path(path)
+        else:
+            time.sleep(0.2)
 
-    try:
         # Open the output devices.
         output_devices = []
         for path, events in output.items():
             output_device = evdev.InputDevice(path)
+            cleanup.callback(output_device.close)
             output_device.grab()
             output_devices.append((output_device, events))
 
-        # Send the input events.
-        for device, events in input_devices.items():
-            for event in events:
-                device.write(*event)
-                if auto_syn:
-                    device.syn()
-                time.sleep(0.01)
+        # Send the input events. Each event and its SYN_REPORT are written with a single syscall.
+        # A test passes a pace to wait that many seconds between reports if its input exceeds the
+        # 64-event evdev client buffer of evsieve, if its exec-shell hooks must print in order, or
+        # if it feeds several non-empty input devices whose relative order is asserted: a burst
+        # spread over several input fds has no defined order in evsieve's poll loop.
+        for device, reports in input_devices:
+            for report in reports:
+                os.write(device.fd, report)
+                if pace > 0:
+                    time.sleep(pace)
 
         # Check whether the output devices have the expected events.
-        time.sleep(0.05)
-        for device, events in output_devices:
-            for event in device.read():
-                if auto_syn and event.type == e.EV_SYN:
-                    continue
-                expected_event = events.pop(0)
-                event = (event.type, event.code, event.value)
+        received_events = read_output_events(output_devices, auto_syn)
+        for (device, events), received in zip(output_devices, received_events):
+            expected_events = iter(events)
+            for event in received:
+                expected_event = next(expected_events, None)
                 if event != expected_event:
-                    raise Exception(f"Unit test failed. Expected event {expected_event}, encountered {event}")
-            if len(events) > 0:
-                raise Exception(f"Unit test failed. Expected events {events}, but the output device closed.")
+                    raise Exception(f"Unit test failed. Expected event {format_event(expected_event)}, encountered {format_event(event)}")
+            missing_events = list(expected_events)
+            if len(missing_events) > 0:
+                missing_events_str = ", ".join(map(format_event, missing_events))
+                raise Exception(f"Unit test failed. Expected events [{missing_events_str}], but the output device closed.")
 
-    finally:
-        # Clean up.
-        for device, _ in output_devices:
-            device.close()
-        if expected_output is not None:
-            time.sleep(0.2)
-        process.terminate()
-        for device in input_devices.keys():
-            device.close()
-        for path in input.keys():
-            os.unlink(path)
-        if expected_output is not None:
-            output = process.stdout.read().decode("utf8")
-            if output != expected_output:
-                raise Exception(f"Unittest failed. Expected the following output:\n{expected_output}\nGot:\n{output}")
+    if expected_output is not None:
+        output = stdout.finish()
+        if output != expected_output:
+            raise Exception(f"Unittest failed. Expected the following output:\n{expected_output}\nGot:\n{output}")
 
 
 def unittest_mirror():
@@ -338,6 +502,7 @@ def unittest_execshell():
         },
         {},
         expected_output = "trigger1\ntrigger1\ntrigger2\ntrigger3\ntrigger4\ntrigger6\ntrigger6\n",
+        pace = 0.01,
     )
 
 def unittest_toggle():
@@ -524,6 +689,7 @@ def unittest_namespace():
             ],
         },
         expected_output="bar\n",
+        pace=0.01,
     )
 
 def unittest_consistency():
@@ -559,15 +725,37 @@ def unittest_consistency():
     )
 
 
-unittest_mirror()
-unittest_capslock()
-unittest_doublectrl()
-unittest_filterbyoutput()
-unittest_domain()
-unittest_kbmousemap()
-unittest_execshell()
-unittest_toggle()
-unittest_yield()
-unittest_order()
-unittest_namespace()
-unittest_consistency()
+TESTS = [
+    unittest_mirror,
+    unittest_capslock,
+    unittest_doublectrl,
+    unittest_filterbyoutput,
+    unittest_domain,
+    unittest_kbmousemap,
+    unittest_execshell,
+    unittest_toggle,
+    unittest_yield,
+    unittest_order,
+    unittest_namespace,
+    unittest_consistency,
+]
+
+def main() -> bool:
+    # Returns whether any test failed, so run_all.py can still run the other scripts first.
+    # Every test uses its own device paths and its own evsieve process, so they can run
+    # concurrently. Most of their time is spent waiting on evsieve rather than computing.
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(test) for test in TESTS]
+
+    failed = False
+    for test, future in zip(TESTS, futures):
+        error = future.exception()
+        if error is not None:
+            print(f"{test.__name__} failed:", file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__)
+            failed = True
+    return failed
+
+if __name__ == "__main__":
+    if main():
+        sys.exit(1)